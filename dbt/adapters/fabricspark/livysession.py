@@ -2,21 +2,34 @@ from __future__ import annotations
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import Response
-from urllib import response
+from urllib3.util.retry import Retry
 import re
+import math
+import asyncio
+import functools
+import random
+import threading
+import collections
 import datetime as dt
 from types import TracebackType
 from typing import Any
-import dbt.exceptions
+from dbt.adapters.exceptions import FailedToConnectError
 from dbt.adapters.events.logging import AdapterLogger
 from dbt.utils import DECIMALS
 from azure.core.credentials import AccessToken
-from azure.identity import AzureCliCredential, ClientSecretCredential
+from azure.core.exceptions import ClientAuthenticationError
+from azure.identity import AzureCliCredential, ClientSecretCredential, TokenCachePersistenceOptions
 from dbt.adapters.fabricspark.fabric_spark_credentials import SparkCredentials
 from dbt.adapters.fabricspark.shortcuts import ShortcutClient
 import textwrap
-from dbt_common.exceptions import DbtDatabaseError
+from dbt_common.exceptions import DbtDatabaseError, DbtRuntimeError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = AdapterLogger("Microsoft Fabric-Spark")
 NUMBERS = DECIMALS + (int, float)
@@ -24,21 +37,231 @@ NUMBERS = DECIMALS + (int, float)
 livysession_credentials: SparkCredentials
 
 DEFAULT_POLL_WAIT = 45
-DEFAULT_POLL_STATEMENT_WAIT = 5
+SESSION_POLL_INITIAL = 2
+SESSION_POLL_FACTOR = 1.5
+SESSION_START_TIMEOUT = 600
+SESSION_INVALID_STATES = ("dead", "shutting_down", "killed", "error")
+SESSION_VALIDATION_TTL = 30
+STATEMENT_POLL_INITIAL = 0.25
+STATEMENT_POLL_MAX = 10
+STATEMENT_POLL_FACTOR = 1.5
+STATEMENT_EAGER_POLLS = 5
+STATEMENT_TERMINAL_STATES = ("available", "error", "cancelled")
 AZURE_CREDENTIAL_SCOPE = "https://analysis.windows.net/powerbi/api/.default"
+TOKEN_CACHE_NAME = "dbt-fabricspark"
 
 DEFAULT_EXECUTE_RETRIES_TIME = 5
 DEFAULT_EXECUTE_RETRIES_WAIT = 10
+DEFAULT_EXECUTE_RETRIES_WAIT_MAX = 60
 EXECUTE_RETRIES_PATTERNS = ["Request failed: HTTP/1.1 403 Forbidden ClientRequestId"]
+# one alternation scans a (possibly large) error value once, however many patterns there are
+_EXECUTE_RETRY_RE = re.compile("|".join(re.escape(pattern) for pattern in EXECUTE_RETRIES_PATTERNS))
+
+TOKEN_REFRESH_WINDOW = 300
+
+_SQL_COMMENT_RE = re.compile(r"\s*/\*.*?\*/\s*", re.DOTALL)
+_SQL_BINDING_RE = re.compile(r"%%|%s")
+
+# Runs a statement with server-side named parameters and reports the result the same way the
+# Livy `sql` kind does, so LivyCursor can read it from `application/json`.
+# Spark 3.5 binds python values directly; Spark 3.4 (Fabric runtime 1.2) only accepts a
+# Dict[str, str] of SQL literals, so the values are rendered as escaped literals there.
+PARAMETERIZED_SQL_TEMPLATE = """\
+import json
+dbt_args = json.loads({args!r})
+if tuple(int(part) for part in spark.version.split(".")[:2]) < (3, 5):
+    dbt_args = {{
+        name: "NULL" if value is None
+        else repr(value) if isinstance(value, float)
+        else "'" + value.replace("\\\\", "\\\\\\\\").replace("'", "\\\\'") + "'"
+        for name, value in dbt_args.items()
+    }}
+dbt_df = spark.sql({sql!r}, args=dbt_args)
+dbt_result = {{
+    "schema": json.loads(dbt_df.schema.json()),
+    "data": [
+        [v if v is None or isinstance(v, (bool, int, float, str)) else str(v) for v in row]
+        for row in dbt_df.collect()
+    ],
+}}
+%json dbt_result
+"""
+
+# (connect, read) timeouts in seconds for every Livy HTTP call
+DEFAULT_HTTP_TIMEOUT = (10, 60)
+HTTP_POOL_MAXSIZE = 32
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
 
 accessToken: AccessToken = None
+_cached_headers: dict[str, str] = None
+_cli_credential: AzureCliCredential = None
+_sp_credential: ClientSecretCredential = None
+_sp_credential_persistent = False
+
+
+class _CappedRetry(Retry):
+    """urllib3 Retry that never sleeps longer than DEFAULT_EXECUTE_RETRIES_WAIT_MAX for a Retry-After."""
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, DEFAULT_EXECUTE_RETRIES_WAIT_MAX)
+
+
+def _build_http_session(retry: Retry) -> requests.Session:
+    # One pooled session keeps TCP/TLS connections to the Livy endpoint alive across polls.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# GET/DELETE are idempotent: transient throttling/gateway errors are retried, honoring Retry-After.
+_http_session = _build_http_session(
+    _CappedRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "DELETE"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+)
+# POST creates sessions and statements: a 500/502/504 or a read timeout may mean the request was
+# already accepted, so only statuses that guarantee it was not processed (429/503) are retried.
+_http_post_session = _build_http_session(
+    _CappedRetry(
+        total=5,
+        read=False,
+        backoff_factor=0.5,
+        status_forcelist=[429, 503],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+)
+
+
+def _json_dumps(obj: Any) -> bytes | str:
+    # orjson serializes large pyspark payloads in C; the Content-Type header is always set explicitly
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+
+def _json_loads(response: Response) -> Any:
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+class _CircuitBreaker:
+    """
+    Fail fast on Livy calls while the endpoint is unhealthy.
+
+    After `failure_threshold` consecutive failures the circuit opens and requests are rejected
+    without hitting the network. Once `reset_timeout` seconds have passed a single probe is let
+    through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_count = 0
+        self.opened_at = 0.0
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise DbtDatabaseError("Livy circuit open")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failure_count = 0
+            self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failure_count += 1
+            if self.state == self.HALF_OPEN or self.failure_count >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_circuit_breaker = _CircuitBreaker()
+
+
+def _do_request(http_session: requests.Session, method: str, url: str, **kwargs) -> Response:
+    # 408 and 5xx (after urllib3 retries) or a transport error count against the circuit
+    kwargs.setdefault("timeout", DEFAULT_HTTP_TIMEOUT)
+    _circuit_breaker.before_request()
+    try:
+        response = http_session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        _circuit_breaker.record_failure()
+        raise
+    if response.status_code == 408 or response.status_code >= 500:
+        _circuit_breaker.record_failure()
+    else:
+        _circuit_breaker.record_success()
+    return response
+
+
+def _backoff_delay(attempt: int, response: Response | None = None) -> float:
+    # honor the server's Retry-After (clamped to the usual maximum wait), otherwise exponential
+    # backoff with full jitter so that many dbt threads retrying together do not hit Fabric in lockstep
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return max(0.0, min(float(retry_after), DEFAULT_EXECUTE_RETRIES_WAIT_MAX))
+            except ValueError:
+                pass
+    return random.uniform(0, min(DEFAULT_EXECUTE_RETRIES_WAIT * 2 ** attempt, DEFAULT_EXECUTE_RETRIES_WAIT_MAX))
+
+
+class _StatementPoller:
+    """
+    Decide how long to wait before polling a running Livy statement again.
+
+    Livy has no long-poll endpoint, so the first few polls of a running statement are sent back
+    to back over the kept-alive connection; after that the wait grows exponentially.
+    """
+
+    def __init__(self) -> None:
+        self.wait = STATEMENT_POLL_INITIAL
+        self.running_polls = 0
+
+    def next_delay(self, state: str) -> float:
+        if state == "running" and self.running_polls < STATEMENT_EAGER_POLLS:
+            self.running_polls += 1
+            return 0
+        delay = self.wait
+        self.wait = min(self.wait * STATEMENT_POLL_FACTOR, STATEMENT_POLL_MAX)
+        return delay
+
+
+def _backoff_sleep(attempt: int, response: Response | None = None) -> None:
+    time.sleep(_backoff_delay(attempt, response))
+
 
 def check_retry_condition_when_execute(res: dict):
-    if res["output"]["status"] == "error":
-        for pattern in EXECUTE_RETRIES_PATTERNS:
-            if pattern in res["output"]["evalue"]:
-                return True
-    return False
+    output = res["output"]
+    return output["status"] == "error" and _EXECUTE_RETRY_RE.search(output["evalue"]) is not None
 
 def check_retry_condition_when_submit_code(res: dict):
     if res["state"] == "error":
@@ -46,18 +269,8 @@ def check_retry_condition_when_submit_code(res: dict):
     return False
 
 def is_token_refresh_necessary(unixTimestamp: int) -> bool:
-    # Convert to datetime object
-    dt_object = dt.datetime.fromtimestamp(unixTimestamp)
-    # Convert to local time
-    local_time = time.localtime(time.time())
-
-    # Calculate difference
-    difference = dt_object - dt.datetime.fromtimestamp(time.mktime(local_time))
-    if int(difference.total_seconds() / 60) < 5:
-        logger.debug(f"Token Refresh necessary in {int(difference.total_seconds() / 60)}")
-        return True
-    else:
-        return False
+    # expires_on is a POSIX timestamp, so compare against time.time() directly
+    return time.time() > unixTimestamp - TOKEN_REFRESH_WINDOW
 
 
 def get_cli_access_token(credentials: SparkCredentials) -> AccessToken:
@@ -80,8 +293,11 @@ def get_cli_access_token(credentials: SparkCredentials) -> AccessToken:
     out : AccessToken
         Access token.
     """
+    global _cli_credential
     _ = credentials
-    accessToken = AzureCliCredential().get_token(AZURE_CREDENTIAL_SCOPE)
+    if _cli_credential is None:
+        _cli_credential = AzureCliCredential()
+    accessToken = _cli_credential.get_token(AZURE_CREDENTIAL_SCOPE)
     logger.debug("CLI - Fetched Access Token")
     return accessToken
 
@@ -100,26 +316,67 @@ def get_sp_access_token(credentials: SparkCredentials) -> AccessToken:
     out : AccessToken
         The access token.
     """
-    accessToken = ClientSecretCredential(
-        str(credentials.tenant_id), str(credentials.client_id), str(credentials.client_secret)
-    ).get_token(AZURE_CREDENTIAL_SCOPE)
+    global _sp_credential, _sp_credential_persistent
+    if _sp_credential is None:
+        # the encrypted disk cache lets later dbt invocations reuse the token instead of calling AAD
+        _sp_credential = _new_sp_credential(credentials, persistent=True)
+        _sp_credential_persistent = True
+    try:
+        accessToken = _sp_credential.get_token(AZURE_CREDENTIAL_SCOPE)
+    except ClientAuthenticationError as ex:
+        if not _sp_credential_persistent or not _is_token_cache_unavailable(ex):
+            raise
+        # e.g. no keyring on a headless build agent, keep the token in memory only
+        logger.debug(f"Persistent token cache unavailable, using in-memory cache: {ex}")
+        _sp_credential = _new_sp_credential(credentials, persistent=False)
+        _sp_credential_persistent = False
+        accessToken = _sp_credential.get_token(AZURE_CREDENTIAL_SCOPE)
     logger.info("SPN - Fetched Access Token")
     return accessToken
 
 
+def _is_token_cache_unavailable(ex: ClientAuthenticationError) -> bool:
+    # azure-identity raises cache persistence failures from get_token, chained under a
+    # ClientAuthenticationError; wrong secrets and AAD outages have a different cause
+    cause = ex.__cause__
+    if isinstance(cause, (ImportError, NotImplementedError)):
+        return True
+    return isinstance(cause, ValueError) and "Cache encryption is impossible" in str(cause)
+
+
+def _new_sp_credential(credentials: SparkCredentials, persistent: bool) -> ClientSecretCredential:
+    kwargs = {}
+    if persistent:
+        kwargs["cache_persistence_options"] = TokenCachePersistenceOptions(
+            name=TOKEN_CACHE_NAME, allow_unencrypted_storage=False
+        )
+    return ClientSecretCredential(
+        str(credentials.tenant_id), str(credentials.client_id), str(credentials.client_secret), **kwargs
+    )
+
+
 def get_headers(credentials: SparkCredentials, tokenPrint: bool = False) -> dict[str, str]:
-    global accessToken
-    if accessToken is None or is_token_refresh_necessary(accessToken.expires_on):
+    global accessToken, _cached_headers
+    # dbt threads call this concurrently: work on locals and only ever publish complete headers,
+    # so a caller racing a token refresh never returns None
+    token = accessToken
+    headers = _cached_headers
+    if token is None or is_token_refresh_necessary(token.expires_on):
         if credentials.authentication and credentials.authentication.lower() == "cli":
             logger.debug("Using CLI auth")
-            accessToken = get_cli_access_token(credentials)
+            token = get_cli_access_token(credentials)
         else:
             logger.debug("Using SPN auth")
-            accessToken = get_sp_access_token(credentials)
-
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {accessToken.token}"}
+            token = get_sp_access_token(credentials)
+        headers = None
+
+    # the same dict is handed out until the token rotates, callers must not mutate it
+    if headers is None:
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {token.token}"}
+        _cached_headers = headers
+        accessToken = token
     if tokenPrint:
-        logger.debug("accessToken:"+accessToken.token)
+        logger.debug("accessToken:"+token.token)
 
     return headers
 
@@ -130,6 +387,11 @@ class LivySession:
         self.connect_url = credentials.lakehouse_endpoint
         self.session_id = None
         self.is_new_session_required = True
+        self._http_session = _http_session
+        self._http_post_session = _http_post_session
+        self._last_validated_at = 0.0
+        self._validation_ttl = float(SESSION_VALIDATION_TTL)
+        self._lock = threading.Lock()
 
     def __enter__(self) -> LivySession:
         return self
@@ -145,108 +407,130 @@ class LivySession:
 
     def create_session(self, data) -> str:
         # Create sessions
-        response = None
         print("Creating Livy session (this may take a few minutes)")
-        try:
-            response = requests.post(
-                self.connect_url + "/sessions",
-                data=json.dumps(data),
-                headers=get_headers(self.credential, True),
-            )
-            if response.status_code == 200:
-                logger.debug("Initiated Livy Session...")
-            response.raise_for_status()
-        except requests.exceptions.ConnectionError as c_err:
-            print("Connection Error :", c_err)
-        except requests.exceptions.HTTPError as h_err:
-            print("Http Error: ", h_err)
-        except requests.exceptions.Timeout as t_err:
-            print("Timeout Error: ", t_err)
-        except requests.exceptions.RequestException as a_err:
-            print("Authorization Error: ", a_err)
-
-        if response is None:
-            raise Exception("Invalid response from livy server")
+        response = _do_request(
+            self._http_post_session,
+            "POST",
+            self.connect_url + "/sessions",
+            data=_json_dumps(data),
+            headers=get_headers(self.credential, True),
+        )
+        if response.status_code == 429:
+            # a 429 that survives the adapter's Retry-After retries means the creation quota is exhausted
+            raise FailedToConnectError(f"Too many Livy sessions created: {response.text}")
+        response.raise_for_status()
+        logger.debug("Initiated Livy Session...")
 
         self.session_id = None
         try:
-            self.session_id = str(response.json()["id"])
-        except requests.exceptions.JSONDecodeError as json_err:
+            self.session_id = str(_json_loads(response)["id"])
+        except json.JSONDecodeError as json_err:
             raise Exception("Json decode error to get session_id") from json_err
 
         # Wait for started state
-        while True:
-            res = requests.get(
-                self.connect_url + "/sessions/" + self.session_id,
-                headers=get_headers(self.credential, False),
-            ).json()
-            if res["state"] == "starting" or res["state"] == "not_started":                
-                # logger.debug("Polling Session creation status - ", self.connect_url + '/sessions/' + self.session_id )
-                time.sleep(DEFAULT_POLL_WAIT)
-            elif res["livyInfo"]["currentState"] == "idle":
-                logger.debug(f"New livy session id is: {self.session_id}, {res}")
-                self.is_new_session_required = False
-                break
-            elif res["livyInfo"]["currentState"] == "dead":
-                print("ERROR, cannot create a livy session")
-                raise dbt.exceptions.FailedToConnectException("failed to connect")
+        res = self._wait_for_session(self.session_id)
+        if res is None:
+            print("ERROR, cannot create a livy session")
+            raise FailedToConnectError("failed to connect")
+        logger.debug(f"New livy session id is: {self.session_id}, {res}")
+        self.is_new_session_required = False
+        self._last_validated_at = time.monotonic()
         print("Livy session created successfully")
         return self.session_id
 
+    def _wait_for_session(self, session_id: str) -> dict | None:
+        """
+        Poll a session until it is idle, backing off from SESSION_POLL_INITIAL up to DEFAULT_POLL_WAIT.
+
+        Returns the session state once idle, or None if the session died while starting.
+        Raises FailedToConnectError when the session is not idle within SESSION_START_TIMEOUT.
+        """
+        deadline = time.monotonic() + SESSION_START_TIMEOUT
+        wait = SESSION_POLL_INITIAL
+        while True:
+            res = _json_loads(_do_request(
+                self._http_session,
+                "GET",
+                self.connect_url + "/sessions/" + session_id,
+                headers=get_headers(self.credential, False),
+            ))
+            if res["state"] not in ("starting", "not_started"):
+                current_state = res["livyInfo"]["currentState"]
+                if current_state == "idle":
+                    return res
+                if current_state in SESSION_INVALID_STATES:
+                    return None
+            if time.monotonic() > deadline:
+                raise FailedToConnectError(
+                    f"Livy session {session_id} was not ready after {SESSION_START_TIMEOUT} seconds"
+                )
+            # logger.debug("Polling Session creation status - ", self.connect_url + '/sessions/' + session_id )
+            time.sleep(wait)
+            wait = min(wait * SESSION_POLL_FACTOR, DEFAULT_POLL_WAIT)
+
     def delete_session(self) -> None:
         logger.debug(f"Closing the livy session: {self.session_id}")
+        # whatever the outcome, the cached validation no longer describes this session
+        self.invalidate_validation()
 
         try:
             # delete the session_id
-            _ = requests.delete(
+            _ = _do_request(
+                self._http_session,
+                "DELETE",
                 self.connect_url + "/sessions/" + self.session_id,
                 headers=get_headers(self.credential, False),
             )
             if _.status_code == 200:
                 logger.debug(f"Closed the livy session: {self.session_id}")
             else:
-                response.raise_for_status()
+                _.raise_for_status()
 
         except Exception as ex:
             logger.error(f"Unable to close the livy session {self.session_id}, error: {ex}")
 
     def is_valid_session(self) -> bool:
-        res = requests.get(
+        # a session validated within the last _validation_ttl seconds is trusted without another GET
+        if time.monotonic() - self._last_validated_at < self._validation_ttl:
+            return True
+        res = _json_loads(_do_request(
+            self._http_session,
+            "GET",
             self.connect_url + "/sessions/" + self.session_id,
             headers=get_headers(self.credential, False),
-        ).json()
+        ))
 
-        # we can reuse the session so long as it is not dead, killed, or being shut down
-        invalid_states = ["dead", "shutting_down", "killed"]
-        return res["livyInfo"]["currentState"] not in invalid_states
+        # we can reuse the session so long as it is not dead, killed, failed, or being shut down
+        ok = res["livyInfo"]["currentState"] not in SESSION_INVALID_STATES
+        if ok:
+            self._last_validated_at = time.monotonic()
+        return ok
+
+    def invalidate_validation(self) -> None:
+        self._last_validated_at = 0.0
 
     def get_exist_session(self) -> str:
         if self.credential.livy_session_name is None:
             return None
         logger.debug(f"Get existing livy session with name: {self.credential.livy_session_name}")
         livy_session_name = self.credential.livy_session_name
-        res = requests.get(
+        res = _json_loads(_do_request(
+            self._http_session,
+            "GET",
             self.connect_url + "/sessions",
             headers=get_headers(self.credential, True),
-        ).json()
+        ))
         for session in res["items"]:
             if session["name"] == livy_session_name:
-                if session["livyState"] in (["dead", "shutting_down", "killed"]):
+                if session["livyState"] in SESSION_INVALID_STATES:
                     continue
-                while True:
-                    res = requests.get(
-                        self.connect_url + "/sessions/" + session["id"],
-                        headers=get_headers(self.credential, False),
-                    ).json()
-                    if res["state"] == "starting" or res["state"] == "not_started":
-                        # logger.debug("Polling Session creation status - ", self.connect_url + '/sessions/' + self.session_id )
-                        time.sleep(DEFAULT_POLL_WAIT)
-                    elif res["livyInfo"]["currentState"] == "idle":
-                        logger.debug(f"Session already exists: {session['id']}, {res}")
-                        self.session_id = session["id"]
-                        break
-            else:
-                continue
+                res = self._wait_for_session(session["id"])
+                if res is None:
+                    continue
+                logger.debug(f"Session already exists: {session['id']}, {res}")
+                self.session_id = session["id"]
+                self._last_validated_at = time.monotonic()
+                break
 
         return self.session_id
 
@@ -257,6 +541,31 @@ class LivySession:
         else:
             return session_id
 
+    def get_session_data(self) -> dict:
+        return {"kind": "sql", "conf": self.credential.livy_session_parameters, "name": self.credential.livy_session_name}  # 'spark'
+
+    def ensure_alive(self) -> str:
+        """
+        Make sure the session can run statements and return its id.
+
+        A healthy session is reused for the whole dbt invocation and is only recreated once
+        is_valid_session() reports it as no longer usable.
+
+        Raises
+        ------
+        FailedToConnectError
+            If the session cannot be checked or recreated, as in LivySessionManager.connect.
+        """
+        with self._lock:
+            try:
+                if not self.is_new_session_required and self.session_id is not None:
+                    if self.is_valid_session():
+                        return self.session_id
+                    self.delete_session()
+                return self.create_session(self.get_session_data())
+            except requests.exceptions.RequestException as ex:
+                raise FailedToConnectError(f"failed to connect to livy: {ex}") from ex
+
     def is_keeping_session(self):
         return self.credential.keep_session
 # cursor object - wrapped for livy API
@@ -276,6 +585,8 @@ class LivyCursor:
         self.connect_url = credential.lakehouse_endpoint
         self.session_id = livy_session.session_id
         self.livy_session = livy_session
+        self._http_session = _http_session
+        self._http_post_session = _http_post_session
 
     def __enter__(self) -> LivyCursor:
         return self
@@ -333,35 +644,40 @@ class LivyCursor:
         self._rows = None
 
     # Add language parameter for diffrent workloads(sql/pyspark).
-    def _submitLivyCode(self, code, language="sql") -> Response:
-        if self.livy_session.is_new_session_required:
-            LivySessionManager.connect(self.credential)
-            self.session_id = self.livy_session.session_id
-
+    def _submitLivyCode(self, code, language="sql") -> dict:
+        self.session_id = self.livy_session.ensure_alive()
+        url, payload = self._getSubmitRequest(code, language)
+        for attempt in range(DEFAULT_EXECUTE_RETRIES_TIME + 1):
+            res = _do_request(
+                self._http_post_session,
+                "POST",
+                url,
+                data=payload,
+                headers=get_headers(self.credential, False),
+            )
+            res_json, retry = self._checkSubmitResponse(res)
+            if not retry:
+                return res_json
+            if attempt < DEFAULT_EXECUTE_RETRIES_TIME:
+                logger.debug(f"Submit code error: {res_json}")
+                logger.info(f"Start retries {attempt + 1}")
+                _backoff_sleep(attempt, res)
+        return res_json
+
+    def _getSubmitRequest(self, code, language) -> tuple[str, bytes | str]:
         # Submit code. Enable pyspark tasks.
         data = {"code": code, "kind": language}
+        url = f"{self.connect_url}/sessions/{self.session_id}/statements"
         logger.info("Submitting livy code")
-        logger.debug(
-            f"Submitted: {data} {self.connect_url + '/sessions/' + self.session_id + '/statements'}"
-        )
-        retries_time = 0
-        while True:
-            res = requests.post(
-                self.connect_url + "/sessions/" + self.session_id + "/statements",
-                data=json.dumps(data),
-                headers=get_headers(self.credential, False),
-            )
-            if check_retry_condition_when_submit_code(res.json()):
-                if retries_time < DEFAULT_EXECUTE_RETRIES_TIME:
-                    logger.debug(f"Submit code error: {res}")
-                    logger.info(f"Start retries {retries_time + 1}")
-                    time.sleep(retries_time * DEFAULT_EXECUTE_RETRIES_WAIT + DEFAULT_EXECUTE_RETRIES_WAIT)
-                    retries_time += 1
-                    continue
-                break
-            return res
+        logger.debug(f"Submitted: {data} {url}")
+        return url, _json_dumps(data)
 
-        return res
+    def _checkSubmitResponse(self, res: Response) -> tuple[dict, bool]:
+        if res.status_code >= 400:
+            # re-check the session before the next statement instead of trusting the cached state
+            self.livy_session.invalidate_validation()
+        res_json = _json_loads(res)
+        return res_json, check_retry_condition_when_submit_code(res_json)
 
     def _getLivySQL(self, sql) -> str:
         # Comment, what is going on?!
@@ -373,31 +689,36 @@ class LivyCursor:
 
         # TODO: since the above code is not changed to sending direct SQL to the livy backend, client side string escaping is probably not needed
 
-        code = re.sub(r"\s*/\*(.|\n)*?\*/\s*", "\n", sql, re.DOTALL).strip()
-        return code
+        return _SQL_COMMENT_RE.sub("\n", sql).strip()
 
     # Trim any common leading whitespace in Python codes.
     def _getLivyPyspark(self, code) -> str:
+        # code whose first line starts at column 0 has no common indent, skip the full scan
+        first = code.lstrip("\n")
+        if first and not first[0].isspace():
+            return code
         return textwrap.dedent(code)
 
-    def _getLivyResult(self, res_obj) -> Response:
-        json_res = res_obj.json()
+    def _getLivyResult(self, json_res: dict) -> dict:
         logger.info(f"""Get livy result: {json_res["id"]}""")
+        # Check the state before sleeping so short statements return as soon as they finish.
+        url = f"{self.connect_url}/sessions/{self.session_id}/statements/{json_res['id']}"
+        poller = _StatementPoller()
         while True:
-            res = requests.get(
-                self.connect_url
-                + "/sessions/"
-                + self.session_id
-                + "/statements/"
-                + repr(json_res["id"]),
+            res = _json_loads(_do_request(
+                self._http_session,
+                "GET",
+                url,
                 headers=get_headers(self.credential, False),
-            ).json()
+            ))
 
             # print(res)
-            if res["state"] == "available":
+            if res["state"] in STATEMENT_TERMINAL_STATES:
                 return res
             logger.info(f"Get response with state {res['state']}")
-            time.sleep(DEFAULT_POLL_STATEMENT_WAIT)
+            delay = poller.next_delay(res["state"])
+            if delay:
+                time.sleep(delay)
 
     # Support pyspark tasks.
     def execute(self, code: str, language: str, *parameters: Any) -> None:
@@ -425,36 +746,45 @@ class LivyCursor:
         # print("LivyCursor.execute()".center(80,'-'))
         # print(f"language={language}")
         # print(code)
+        retries_time = 0
+        final_code = self._getLivyCode(code, language, parameters)
+        logger.info("Start to execute livy code")
+        while True:
+            res = self._getLivyResult(self._submitLivyCode(final_code, language))
+            if res["state"] != "available":
+                raise DbtDatabaseError(
+                    f"Livy statement {res['id']} finished with state {res['state']}"
+                )
+            logger.info("Get result with available state")
+            if check_retry_condition_when_execute(res):
+                if retries_time < DEFAULT_EXECUTE_RETRIES_TIME:
+                    logger.debug(f"Get result is available but facing error: {res}")
+                    logger.info(f"Start retries {retries_time + 1}")
+                    _backoff_sleep(retries_time)
+                    retries_time += 1
+                    continue
+            break
+        self._setLivyResult(res)
+
+    def _getLivyCode(self, code: str, language: str, parameters: tuple) -> str:
         if len(parameters) > 0:
             code = code % parameters
 
         # TODO: handle parameterised sql
 
-        retries_time = 0
         # final process for submition
-        final_code = self._getLivyPyspark(code) if language == "pyspark" else self._getLivySQL(code)
-        logger.info("Start to execute livy code")
-        while True:
-            res = self._getLivyResult(self._submitLivyCode(final_code, language))
-            if res["state"] == "available":
-                logger.info("Get result with available state")
-                if check_retry_condition_when_execute(res):
-                    if retries_time < DEFAULT_EXECUTE_RETRIES_TIME:
-                        logger.debug(f"Get result is available but facing error: {res}")
-                        logger.info(f"Start retries {retries_time + 1}")
-                        time.sleep(retries_time * DEFAULT_EXECUTE_RETRIES_WAIT + DEFAULT_EXECUTE_RETRIES_WAIT)
-                        retries_time += 1
-                        continue
-                break
+        return self._getLivyPyspark(code) if language == "pyspark" else self._getLivySQL(code)
+
+    def _setLivyResult(self, res: dict) -> None:
         if res["output"]["status"] == "ok":
             values = res["output"]["data"]["application/json"]
             if len(values) >= 1:
-                self._rows = values["data"]  # values[0]['values']
+                self._rows = collections.deque(values["data"])  # values[0]['values']
                 self._schema = values["schema"]["fields"]  # values[0]['schema']
                 # print("rows", self._rows)
                 # print("schema", self._schema)
             else:
-                self._rows = []
+                self._rows = collections.deque()
                 self._schema = []
         else:
             self._rows = None
@@ -476,7 +806,11 @@ class LivyCursor:
         ------
         https://github.com/mkleehammer/pyodbc/wiki/Cursor#fetchall
         """
-        return self._rows
+        if self._rows is None:
+            return None
+        rows = list(self._rows)
+        self._rows.clear()
+        return rows
 
     def fetchone(self):
         """
@@ -491,13 +825,142 @@ class LivyCursor:
         ------
         https://github.com/mkleehammer/pyodbc/wiki/Cursor#fetchone
         """
+        return self._rows.popleft() if self._rows else None
 
-        if self._rows is not None and len(self._rows) > 0:
-            row = self._rows.pop(0)
-        else:
-            row = None
 
-        return row
+def _check_no_running_loop(caller: str, alternative: str) -> None:
+    # asyncio.run() cannot be nested, fail with a clear message instead of its generic RuntimeError
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    raise DbtRuntimeError(f"{caller} cannot be called from a running event loop, {alternative} instead")
+
+
+class AsyncLivyCursor(LivyCursor):
+    """
+    A LivyCursor that waits on statements with asyncio instead of blocking a thread.
+
+    HTTP calls still go through the pooled sessions, retries and circuit breaker; they run in the
+    event loop's default executor while every wait between submit retries and polls is an
+    `asyncio.sleep`. This lets a single thread keep many independent statements in flight, see
+    `execute_concurrently`.
+
+    The adapter's connections keep using LivyCursor; this cursor is opt-in API for callers that
+    want to run independent statements concurrently.
+    """
+
+    def _request(self, http_session: requests.Session, method: str, url: str, **kwargs: Any) -> Response:
+        # get_headers may refresh the token (an `az` subprocess for CLI auth), keep it off the event loop
+        return _do_request(http_session, method, url, headers=get_headers(self.credential, False), **kwargs)
+
+    async def _arequest(self, http_session: requests.Session, method: str, url: str, **kwargs: Any) -> Response:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self._request, http_session, method, url, **kwargs)
+        )
+
+    async def _asubmitLivyCode(self, code, language="sql") -> dict:
+        loop = asyncio.get_running_loop()
+        self.session_id = await loop.run_in_executor(None, self.livy_session.ensure_alive)
+        url, payload = self._getSubmitRequest(code, language)
+        for attempt in range(DEFAULT_EXECUTE_RETRIES_TIME + 1):
+            res = await self._arequest(self._http_post_session, "POST", url, data=payload)
+            res_json, retry = self._checkSubmitResponse(res)
+            if not retry:
+                return res_json
+            if attempt < DEFAULT_EXECUTE_RETRIES_TIME:
+                logger.debug(f"Submit code error: {res_json}")
+                logger.info(f"Start retries {attempt + 1}")
+                await asyncio.sleep(_backoff_delay(attempt, res))
+        return res_json
+
+    async def _agetLivyResult(self, json_res: dict) -> dict:
+        logger.info(f"""Get livy result: {json_res["id"]}""")
+        url = f"{self.connect_url}/sessions/{self.session_id}/statements/{json_res['id']}"
+        poller = _StatementPoller()
+        while True:
+            res = _json_loads(await self._arequest(self._http_session, "GET", url))
+
+            if res["state"] in STATEMENT_TERMINAL_STATES:
+                return res
+            logger.info(f"Get response with state {res['state']}")
+            delay = poller.next_delay(res["state"])
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def aexecute(self, code: str, language: str, *parameters: Any) -> None:
+        """
+        Execute a sql statement or a pyspark statement, see `LivyCursor.execute`.
+        """
+        retries_time = 0
+        final_code = self._getLivyCode(code, language, parameters)
+        logger.info("Start to execute livy code")
+        while True:
+            res = await self._agetLivyResult(await self._asubmitLivyCode(final_code, language))
+            if res["state"] != "available":
+                raise DbtDatabaseError(
+                    f"Livy statement {res['id']} finished with state {res['state']}"
+                )
+            logger.info("Get result with available state")
+            if check_retry_condition_when_execute(res):
+                if retries_time < DEFAULT_EXECUTE_RETRIES_TIME:
+                    logger.debug(f"Get result is available but facing error: {res}")
+                    logger.info(f"Start retries {retries_time + 1}")
+                    await asyncio.sleep(_backoff_delay(retries_time))
+                    retries_time += 1
+                    continue
+            break
+        self._setLivyResult(res)
+
+    def execute(self, code: str, language: str, *parameters: Any) -> None:
+        """
+        Run `aexecute` to completion on a new event loop.
+
+        Raises
+        ------
+        DbtRuntimeError
+            If called from a running event loop, await `aexecute` there instead.
+        """
+        _check_no_running_loop("AsyncLivyCursor.execute", "await aexecute()")
+        asyncio.run(self.aexecute(code, language, *parameters))
+
+    @classmethod
+    def execute_concurrently(
+        cls, credential: SparkCredentials, livy_session: LivySession, statements: list[tuple[str, str]]
+    ) -> list[AsyncLivyCursor]:
+        """
+        Execute independent statements concurrently on one event loop.
+
+        Parameters
+        ----------
+        credential : SparkCredentials
+            The credentials.
+        livy_session : LivySession
+            The session the statements are submitted to.
+        statements : list[tuple[str, str]]
+            (code, language) pairs.
+
+        Returns
+        -------
+        out : list[AsyncLivyCursor]
+            One cursor per statement, in order, holding its result.
+
+        Raises
+        ------
+        DbtRuntimeError
+            If called from a running event loop, gather `aexecute` calls there instead.
+        """
+        _check_no_running_loop("AsyncLivyCursor.execute_concurrently", "gather aexecute() calls")
+        cursors = [cls(credential, livy_session) for _ in statements]
+
+        async def _gather() -> None:
+            await asyncio.gather(
+                *(cursor.aexecute(code, language) for cursor, (code, language) in zip(cursors, statements))
+            )
+
+        asyncio.run(_gather())
+        return cursors
 
 
 class LivyConnection:
@@ -561,36 +1024,40 @@ class LivyConnection:
 # TODO: How to authenticate
 class LivySessionManager:
     livy_global_session = None
+    # dbt opens connections from several worker threads; only one of them may create the session
+    _lock = threading.Lock()
 
     @staticmethod
     def connect(credentials: SparkCredentials) -> LivyConnection:
-        # the following opens an spark / sql session
-        data = {"kind": "sql", "conf": credentials.livy_session_parameters, "name": credentials.livy_session_name}  # 'spark'
-        if __class__.livy_global_session is None:
-            __class__.livy_global_session = LivySession(credentials)
-            __class__.livy_global_session.get_exist_session_or_create(data)
-            __class__.livy_global_session.is_new_session_required = False
-            # create shortcuts, if there are any
-            if credentials.shortcuts_json_path:
-                shortcut_client = ShortcutClient(accessToken.token, credentials.workspaceid, credentials.lakehouseid)
-                shortcut_client.create_shortcuts(credentials.shortcuts_json_path)
-        elif not __class__.livy_global_session.is_valid_session():
-            __class__.livy_global_session.delete_session()
-            __class__.livy_global_session.create_session(data)
-            __class__.livy_global_session.is_new_session_required = False
-        elif __class__.livy_global_session.is_new_session_required:
-            __class__.livy_global_session.create_session(data)
-            __class__.livy_global_session.is_new_session_required = False
-        else:
-            logger.debug(f"Reusing session: {__class__.livy_global_session.session_id}")
-        livyConnection = LivyConnection(credentials, __class__.livy_global_session)
+        with LivySessionManager._lock:
+            try:
+                # the following opens an spark / sql session
+                if LivySessionManager.livy_global_session is None:
+                    livy_session = LivySession(credentials)
+                    livy_session.get_exist_session_or_create(livy_session.get_session_data())
+                    livy_session.is_new_session_required = False
+                    LivySessionManager.livy_global_session = livy_session
+                    # create shortcuts, if there are any
+                    if credentials.shortcuts_json_path:
+                        shortcut_client = ShortcutClient(accessToken.token, credentials.workspaceid, credentials.lakehouseid)
+                        shortcut_client.create_shortcuts(credentials.shortcuts_json_path)
+                else:
+                    LivySessionManager.livy_global_session.ensure_alive()
+            except requests.exceptions.RequestException as ex:
+                raise FailedToConnectError(f"failed to connect to livy: {ex}") from ex
+            livyConnection = LivyConnection(credentials, LivySessionManager.livy_global_session)
         return livyConnection
 
     @staticmethod
     def disconnect() -> None:
-        if __class__.livy_global_session.is_valid_session() and not __class__.livy_global_session.is_keeping_session():
-            __class__.livy_global_session.delete_session()
-            __class__.livy_global_session.is_new_session_required = True
+        with LivySessionManager._lock:
+            livy_session = LivySessionManager.livy_global_session
+            # cleanup_all calls this once per thread manager, only the first call deletes
+            if livy_session is None or livy_session.is_new_session_required:
+                return
+            if livy_session.is_valid_session() and not livy_session.is_keeping_session():
+                livy_session.delete_session()
+                livy_session.is_new_session_required = True
 
 
 class LivySessionConnectionWrapper(object):
@@ -628,10 +1095,14 @@ class LivySessionConnectionWrapper(object):
         if sql.strip().endswith(";"):
             sql = sql.strip()[:-1]
 
-        if bindings is None:
+        if not bindings:
             self._cursor.execute(sql, language)
-        else:
+        elif language == "sql":
+            # bind values on the Spark side instead of formatting them into the statement
             bindings = [self._fix_binding(binding) for binding in bindings]
+            self._cursor.execute(self._get_parameterized_code(sql, bindings), "pyspark")
+        else:
+            bindings = [self._quote_binding(self._fix_binding(binding)) for binding in bindings]
             self._cursor.execute(sql, language, *bindings)
 
     @property
@@ -645,8 +1116,38 @@ class LivySessionConnectionWrapper(object):
         if isinstance(value, NUMBERS):
             return float(value)
         elif isinstance(value, dt.datetime):
-            return f"'{value.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]}'"
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        elif value is None:
+            return None
+        else:
+            return str(value)
+
+    @classmethod
+    def _quote_binding(cls, value):
+        """Render a fixed binding as a SQL literal for client-side interpolation"""
+        if isinstance(value, float):
+            return value
         elif value is None:
             return "''"
         else:
             return f"'{value}'"
+
+    @classmethod
+    def _get_parameterized_code(cls, sql, bindings):
+        """Turn a statement with `%s` placeholders into pyspark code that binds
+        the values as named parameters of `spark.sql`"""
+        for value in bindings:
+            if isinstance(value, float) and not math.isfinite(value):
+                raise DbtRuntimeError(f"Cannot bind non-finite number {value!r} as a SQL parameter")
+        placeholders = sum(1 for m in _SQL_BINDING_RE.finditer(sql) if m.group() == "%s")
+        if placeholders != len(bindings):
+            raise DbtRuntimeError(
+                f"Statement has {placeholders} placeholders but {len(bindings)} bindings were given"
+            )
+        names = iter(range(len(bindings)))
+        sql = _SQL_BINDING_RE.sub(lambda m: "%" if m.group() == "%%" else f":p{next(names)}", sql)
+        args = {f"p{i}": value for i, value in enumerate(bindings)}
+        payload = _json_dumps(args)
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        return PARAMETERIZED_SQL_TEMPLATE.format(args=payload, sql=_SQL_COMMENT_RE.sub("\n", sql).strip())
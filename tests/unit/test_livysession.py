@@ -0,0 +1,641 @@
+import asyncio
+import datetime as dt
+import json
+import threading
+import unittest
+from unittest import mock
+
+from dbt.adapters.fabricspark import SparkCredentials
+from dbt.adapters.fabricspark import livysession
+from dbt.adapters.fabricspark.livysession import (
+    AsyncLivyCursor,
+    LivyCursor,
+    LivySession,
+    LivySessionConnectionWrapper,
+    LivySessionManager,
+)
+
+
+def _credentials() -> SparkCredentials:
+    return SparkCredentials(
+        method="livy",
+        authentication="CLI",
+        lakehouse="tests",
+        schema="tests",
+        workspaceid="workspace_id",
+        lakehouseid="lakehouse_id",
+    )
+
+
+def _response(payload):
+    response = mock.Mock()
+    response.status_code = 200
+    response.headers = {}
+    response.json.return_value = payload
+    response.content = json.dumps(payload).encode()
+    return response
+
+
+class TestLivyCursor(unittest.TestCase):
+    def setUp(self):
+        self.credentials = _credentials()
+        self.session = LivySession(self.credentials)
+        self.session.session_id = "1"
+        self.session.is_new_session_required = False
+        self.cursor = LivyCursor(self.credentials, self.session)
+        self.http = self.cursor._http_session = self.cursor._http_post_session = mock.Mock()
+        for patcher in (
+            mock.patch.object(livysession, "get_headers", return_value={}),
+            mock.patch.object(livysession, "_circuit_breaker", livysession._CircuitBreaker()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_livy_result_does_not_sleep_when_available(self):
+        with mock.patch("time.sleep") as mock_sleep:
+            self.http.request.return_value = _response({"id": 7, "state": "available"})
+            res = self.cursor._getLivyResult({"id": 7})
+            self.assertEqual(res["state"], "available")
+            mock_sleep.assert_not_called()
+
+    def test_get_livy_result_backs_off_exponentially(self):
+        states = ["waiting", "waiting", "waiting", "available"]
+        with mock.patch("time.sleep") as mock_sleep:
+            self.http.request.side_effect = [_response({"id": 7, "state": state}) for state in states]
+            self.cursor._getLivyResult({"id": 7})
+            waits = [call.args[0] for call in mock_sleep.call_args_list]
+            self.assertEqual(waits, [0.25, 0.375, 0.5625])
+
+    def test_get_livy_result_polls_running_statement_eagerly(self):
+        eager = livysession.STATEMENT_EAGER_POLLS
+        states = ["waiting"] + ["running"] * (eager + 2) + ["available"]
+        with mock.patch("time.sleep") as mock_sleep:
+            self.http.request.side_effect = [_response({"id": 7, "state": state}) for state in states]
+            self.cursor._getLivyResult({"id": 7})
+            waits = [call.args[0] for call in mock_sleep.call_args_list]
+            self.assertEqual(waits, [0.25, 0.375, 0.5625])
+
+    def test_get_livy_result_url_does_not_quote_statement_id(self):
+        self.http.request.return_value = _response({"id": "7", "state": "available"})
+        self.cursor._getLivyResult({"id": "7"})
+        self.assertTrue(self.http.request.call_args.args[1].endswith("/sessions/1/statements/7"))
+
+    def test_get_livy_result_sets_timeout(self):
+        self.http.request.return_value = _response({"id": 7, "state": "available"})
+        self.cursor._getLivyResult({"id": 7})
+        self.assertEqual(self.http.request.call_args.kwargs["timeout"], livysession.DEFAULT_HTTP_TIMEOUT)
+
+    def test_get_livy_sql_strips_all_block_comments(self):
+        sql = "\n".join(f"/* comment {i}\n spanning lines */ select {i};" for i in range(20))
+        code = self.cursor._getLivySQL(sql)
+        self.assertNotIn("comment", code)
+        self.assertTrue(code.startswith("select 0;"))
+
+    def test_submit_livy_code_retries_errors(self):
+        self.session._last_validated_at = livysession.time.monotonic()
+        self.http.request.side_effect = [_response({"id": 1, "state": "error"}), _response({"id": 2, "state": "waiting"})]
+        with mock.patch.object(livysession, "_backoff_sleep") as mock_sleep:
+            self.assertEqual(self.cursor._submitLivyCode("select 1"), {"id": 2, "state": "waiting"})
+            mock_sleep.assert_called_once()
+
+    def test_submit_livy_code_gives_up_after_retries(self):
+        self.session._last_validated_at = livysession.time.monotonic()
+        self.http.request.return_value = _response({"id": 1, "state": "error"})
+        with mock.patch.object(livysession, "_backoff_sleep") as mock_sleep:
+            self.assertEqual(self.cursor._submitLivyCode("select 1")["state"], "error")
+        self.assertEqual(self.http.request.call_count, livysession.DEFAULT_EXECUTE_RETRIES_TIME + 1)
+        self.assertEqual(mock_sleep.call_count, livysession.DEFAULT_EXECUTE_RETRIES_TIME)
+
+    def test_get_livy_pyspark_dedents_indented_code(self):
+        self.assertEqual(self.cursor._getLivyPyspark("\n    x = 1\n    y = 2\n"), "\nx = 1\ny = 2\n")
+
+    def test_get_livy_pyspark_keeps_top_level_code(self):
+        code = "\ndef model(dbt, session):\n    return 1\n"
+        with mock.patch("textwrap.dedent") as mock_dedent:
+            self.assertEqual(self.cursor._getLivyPyspark(code), code)
+            mock_dedent.assert_not_called()
+
+    def test_fetch_rows(self):
+        result = {
+            "id": 7,
+            "state": "available",
+            "output": {
+                "status": "ok",
+                "data": {"application/json": {"data": [[1], [2], [3]], "schema": {"fields": []}}},
+            },
+        }
+        with mock.patch.object(self.cursor, "_submitLivyCode"), mock.patch.object(
+            self.cursor, "_getLivyResult", return_value=result
+        ):
+            self.cursor.execute("select 1", "sql")
+        self.assertEqual(self.cursor.fetchone(), [1])
+        self.assertEqual(self.cursor.fetchall(), [[2], [3]])
+        self.assertIsNone(self.cursor.fetchone())
+
+    def test_execute_raises_on_terminal_error_state(self):
+        with mock.patch.object(self.cursor, "_submitLivyCode"), mock.patch.object(
+            self.cursor, "_getLivyResult", return_value={"id": 7, "state": "cancelled"}
+        ):
+            with self.assertRaises(livysession.DbtDatabaseError):
+                self.cursor.execute("select 1", "sql")
+
+
+class TestAsyncLivyCursor(unittest.TestCase):
+    def setUp(self):
+        self.credentials = _credentials()
+        self.session = LivySession(self.credentials)
+        self.session.session_id = "1"
+        for patcher in (
+            mock.patch.object(livysession, "get_headers", return_value={}),
+            mock.patch.object(livysession, "_circuit_breaker", livysession._CircuitBreaker()),
+            mock.patch.object(livysession, "_http_session", mock.Mock()),
+            mock.patch.object(livysession, "_http_post_session", mock.Mock()),
+            mock.patch.object(LivySession, "ensure_alive", return_value="1"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _result(self, statement_id):
+        data = {"data": [[statement_id]], "schema": {"fields": []}}
+        return _response(
+            {
+                "id": statement_id,
+                "state": "available",
+                "output": {"status": "ok", "data": {"application/json": data}},
+            }
+        )
+
+    def test_execute_concurrently(self):
+        livysession._http_session.request.side_effect = lambda method, url, **kwargs: self._result(
+            int(url.rsplit("/", 1)[1])
+        )
+        submitted = iter(range(3))
+        in_flight = 0
+        max_in_flight = 0
+
+        async def submit(cursor, code, language):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {"id": next(submitted)}
+
+        with mock.patch.object(AsyncLivyCursor, "_asubmitLivyCode", submit):
+            cursors = AsyncLivyCursor.execute_concurrently(
+                self.credentials, self.session, [("select 1", "sql")] * 3
+            )
+        self.assertEqual(max_in_flight, 3)
+        self.assertEqual(sorted(cursor.fetchone()[0] for cursor in cursors), [0, 1, 2])
+
+    def test_execute_runs_on_event_loop(self):
+        cursor = AsyncLivyCursor(self.credentials, self.session)
+        livysession._http_post_session.request.return_value = _response({"id": 7, "state": "waiting"})
+        livysession._http_session.request.return_value = self._result(7)
+        cursor.execute("select 1", "sql")
+        self.assertEqual(cursor.fetchall(), [[7]])
+
+    def test_submit_retries_without_blocking_the_thread(self):
+        cursor = AsyncLivyCursor(self.credentials, self.session)
+        livysession._http_post_session.request.side_effect = [
+            _response({"id": 7, "state": "error"}),
+            _response({"id": 7, "state": "waiting"}),
+        ]
+        livysession._http_session.request.return_value = self._result(7)
+        with mock.patch("time.sleep") as mock_sleep, mock.patch.object(
+            livysession.asyncio, "sleep", mock.AsyncMock()
+        ) as mock_async_sleep:
+            cursor.execute("select 1", "sql")
+        mock_sleep.assert_not_called()
+        mock_async_sleep.assert_awaited_once()
+        self.assertEqual(livysession._http_post_session.request.call_count, 2)
+
+    def test_headers_are_fetched_off_the_event_loop(self):
+        cursor = AsyncLivyCursor(self.credentials, self.session)
+        livysession._http_post_session.request.return_value = _response({"id": 7, "state": "waiting"})
+        livysession._http_session.request.return_value = self._result(7)
+        threads = []
+        livysession.get_headers.side_effect = lambda *args: threads.append(threading.get_ident()) or {}
+        cursor.execute("select 1", "sql")
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_execute_inside_running_loop_raises(self):
+        cursor = AsyncLivyCursor(self.credentials, self.session)
+
+        async def run():
+            cursor.execute("select 1", "sql")
+
+        with self.assertRaises(livysession.DbtRuntimeError):
+            asyncio.run(run())
+
+
+class TestLivySessionConnectionWrapper(unittest.TestCase):
+    def setUp(self):
+        self.cursor = mock.Mock()
+        self.wrapper = LivySessionConnectionWrapper(mock.Mock())
+        self.wrapper._cursor = self.cursor
+
+    def test_execute_without_bindings_runs_sql(self):
+        self.wrapper.execute("select 1;", "sql")
+        self.cursor.execute.assert_called_once_with("select 1", "sql")
+
+    def test_execute_with_bindings_binds_on_server(self):
+        self.wrapper.execute(
+            "insert into t values (%s, %s, %s, '100%%')", "sql", [1, None, dt.datetime(2024, 1, 2, 3, 4, 5)]
+        )
+        code, language = self.cursor.execute.call_args.args
+        self.assertEqual(language, "pyspark")
+        self.assertIn(
+            """spark.sql("insert into t values (:p0, :p1, :p2, '100%')", args=dbt_args)""", code
+        )
+        self.assertIn(
+            """json.loads('{"p0":1.0,"p1":null,"p2":"2024-01-02 03:04:05.000"}')""",
+            code.replace(", ", ",").replace(": ", ":"),
+        )
+
+    def _run_parameterized_code(self, spark_version, sql, bindings):
+        code = LivySessionConnectionWrapper._get_parameterized_code(
+            sql, [LivySessionConnectionWrapper._fix_binding(binding) for binding in bindings]
+        )
+        body, magic = code.rstrip("\n").rsplit("\n", 1)
+        self.assertEqual(magic, "%json dbt_result")
+        df = mock.Mock()
+        df.schema.json.return_value = json.dumps({"type": "struct", "fields": [{"name": "a", "type": "int", "nullable": True}]})
+        df.collect.return_value = [(1, dt.date(2024, 1, 2))]
+        spark = mock.Mock(version=spark_version)
+        spark.sql.return_value = df
+        namespace = {"spark": spark}
+        exec(body, namespace)
+        return spark.sql.call_args, namespace["dbt_result"]
+
+    def test_parameterized_code_binds_python_values_on_spark_3_5(self):
+        call, result = self._run_parameterized_code(
+            "3.5.1.5.4.20240407.1", "insert into t values (%s, %s, %s)", [1, None, "it's"]
+        )
+        self.assertEqual(call.args, ("insert into t values (:p0, :p1, :p2)",))
+        self.assertEqual(call.kwargs["args"], {"p0": 1.0, "p1": None, "p2": "it's"})
+        self.assertEqual(result["data"], [[1, "2024-01-02"]])
+        self.assertEqual(result["schema"]["fields"][0]["name"], "a")
+
+    def test_parameterized_code_binds_sql_literals_on_spark_3_4(self):
+        call, _ = self._run_parameterized_code(
+            "3.4.1.5.3.20230713", "insert into t values (%s, %s, %s, %s)", [1, None, "it's", "a\\b"]
+        )
+        self.assertEqual(
+            call.kwargs["args"],
+            {"p0": "1.0", "p1": "NULL", "p2": "'it\\'s'", "p3": "'a\\\\b'"},
+        )
+
+    def test_parameterized_code_rejects_binding_count_mismatch(self):
+        for sql, bindings in (("select %s, %s", [1]), ("select %s, '100%%'", [1, 2])):
+            with self.assertRaises(livysession.DbtRuntimeError):
+                LivySessionConnectionWrapper._get_parameterized_code(sql, bindings)
+
+    def test_parameterized_code_rejects_non_finite_numbers(self):
+        for value in (float("nan"), float("inf")):
+            with self.assertRaises(livysession.DbtRuntimeError):
+                LivySessionConnectionWrapper._get_parameterized_code("select %s", [value])
+
+
+class TestLivySession(unittest.TestCase):
+    def setUp(self):
+        self.session = LivySession(_credentials())
+        self.http = self.session._http_session = self.session._http_post_session = mock.Mock()
+        for patcher in (
+            mock.patch.object(livysession, "get_headers", return_value={}),
+            mock.patch.object(livysession, "_circuit_breaker", livysession._CircuitBreaker()),
+            mock.patch("time.sleep"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_wait_for_session_returns_when_idle(self):
+        self.http.request.side_effect = [
+            _response({"state": "starting"}),
+            _response({"state": "idle", "livyInfo": {"currentState": "idle"}}),
+        ]
+        res = self.session._wait_for_session("1")
+        self.assertEqual(res["state"], "idle")
+
+    def test_wait_for_session_returns_none_when_dead(self):
+        self.http.request.return_value = _response({"state": "dead", "livyInfo": {"currentState": "dead"}})
+        self.assertIsNone(self.session._wait_for_session("1"))
+
+    def test_wait_for_session_times_out(self):
+        self.http.request.return_value = _response({"state": "starting"})
+        with mock.patch("time.monotonic", side_effect=[0, 10, livysession.SESSION_START_TIMEOUT + 1]):
+            with self.assertRaises(livysession.FailedToConnectError):
+                self.session._wait_for_session("1")
+
+    def test_ensure_alive_reuses_recently_validated_session(self):
+        self.session.session_id = "1"
+        self.session.is_new_session_required = False
+        self.session._last_validated_at = livysession.time.monotonic()
+        with mock.patch.object(self.session, "create_session") as mock_create:
+            self.assertEqual(self.session.ensure_alive(), "1")
+            mock_create.assert_not_called()
+        self.http.request.assert_not_called()
+
+    def test_ensure_alive_recreates_invalid_session(self):
+        self.session.session_id = "1"
+        self.session.is_new_session_required = False
+        with mock.patch.object(self.session, "is_valid_session", return_value=False), mock.patch.object(
+            self.session, "delete_session"
+        ) as mock_delete, mock.patch.object(self.session, "create_session", return_value="2") as mock_create:
+            self.assertEqual(self.session.ensure_alive(), "2")
+            mock_delete.assert_called_once()
+            mock_create.assert_called_once_with(self.session.get_session_data())
+
+    def test_ensure_alive_wraps_http_errors(self):
+        self.session.is_new_session_required = True
+        with mock.patch.object(
+            self.session,
+            "create_session",
+            side_effect=livysession.requests.exceptions.HTTPError("401 Unauthorized"),
+        ):
+            with self.assertRaises(livysession.FailedToConnectError):
+                self.session.ensure_alive()
+
+    def test_is_valid_session_is_cached(self):
+        self.session.session_id = "1"
+        self.http.request.return_value = _response({"livyInfo": {"currentState": "idle"}})
+        self.assertTrue(self.session.is_valid_session())
+        self.assertTrue(self.session.is_valid_session())
+        self.assertEqual(self.http.request.call_count, 1)
+        self.session.invalidate_validation()
+        self.assertTrue(self.session.is_valid_session())
+        self.assertEqual(self.http.request.call_count, 2)
+
+    def test_is_valid_session_does_not_cache_dead_session(self):
+        self.session.session_id = "1"
+        self.http.request.return_value = _response({"livyInfo": {"currentState": "dead"}})
+        self.assertFalse(self.session.is_valid_session())
+        self.assertFalse(self.session.is_valid_session())
+        self.assertEqual(self.http.request.call_count, 2)
+        self.http.request.return_value = _response({"livyInfo": {"currentState": "error"}})
+        self.assertFalse(self.session.is_valid_session())
+
+    def test_get_exist_session_stops_at_first_match(self):
+        self.session.credential.livy_session_name = "dbt"
+        self.http.request.return_value = _response(
+            {
+                "items": [
+                    {"id": "1", "name": "dbt", "livyState": "idle"},
+                    {"id": "2", "name": "dbt", "livyState": "idle"},
+                ]
+            }
+        )
+        with mock.patch.object(self.session, "_wait_for_session", return_value={}) as mock_wait:
+            self.assertEqual(self.session.get_exist_session(), "1")
+            mock_wait.assert_called_once_with("1")
+
+    def test_get_exist_session_skips_failed_sessions(self):
+        self.session.credential.livy_session_name = "dbt"
+        self.http.request.return_value = _response(
+            {
+                "items": [
+                    {"id": "1", "name": "dbt", "livyState": "error"},
+                    {"id": "2", "name": "dbt", "livyState": "idle"},
+                ]
+            }
+        )
+        with mock.patch.object(self.session, "_wait_for_session", return_value={}) as mock_wait:
+            self.assertEqual(self.session.get_exist_session(), "2")
+            mock_wait.assert_called_once_with("2")
+
+    def test_create_session_raises_on_http_error(self):
+        failed = _response({})
+        failed.status_code = 401
+        failed.raise_for_status.side_effect = livysession.requests.exceptions.HTTPError("401 Unauthorized")
+        self.http.request.return_value = failed
+        with self.assertRaises(livysession.requests.exceptions.HTTPError):
+            self.session.create_session(self.session.get_session_data())
+        self.assertEqual(self.http.request.call_count, 1)
+
+    def test_create_session_raises_when_throttled(self):
+        throttled = _response({})
+        throttled.status_code = 429
+        self.http.request.return_value = throttled
+        with self.assertRaises(livysession.FailedToConnectError):
+            self.session.create_session(self.session.get_session_data())
+
+
+class TestLivySessionManager(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(LivySessionManager, "livy_global_session", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_connect_creates_one_session(self):
+        created = []
+
+        def create(session, data):
+            created.append(session)
+            session.session_id = str(len(created))
+            return session.session_id
+
+        with mock.patch.object(LivySession, "get_exist_session_or_create", autospec=True, side_effect=create), \
+                mock.patch.object(LivySession, "ensure_alive", autospec=True) as mock_ensure_alive:
+            threads = [threading.Thread(target=LivySessionManager.connect, args=(_credentials(),)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(created), 1)
+        self.assertEqual(mock_ensure_alive.call_count, 7)
+
+    def test_connect_wraps_http_errors(self):
+        with mock.patch.object(
+            LivySession,
+            "get_exist_session_or_create",
+            side_effect=livysession.requests.exceptions.HTTPError("500 Server Error"),
+        ):
+            with self.assertRaises(livysession.FailedToConnectError):
+                LivySessionManager.connect(_credentials())
+        self.assertIsNone(LivySessionManager.livy_global_session)
+
+    def test_repeated_disconnect_deletes_session_once(self):
+        livy_session = LivySession(_credentials())
+        livy_session.session_id = "1"
+        livy_session.is_new_session_required = False
+        livy_session._http_session = mock.Mock()
+        livy_session._http_session.request.return_value = _response({"livyInfo": {"currentState": "idle"}})
+        with mock.patch.object(livysession, "get_headers", return_value={}), mock.patch.object(
+            livysession, "_circuit_breaker", livysession._CircuitBreaker()
+        ), mock.patch.object(LivySessionManager, "livy_global_session", livy_session):
+            for _ in range(3):
+                LivySessionManager.disconnect()
+        methods = [call.args[0] for call in livy_session._http_session.request.call_args_list]
+        self.assertEqual(methods, ["GET", "DELETE"])
+        self.assertEqual(livy_session._last_validated_at, 0.0)
+
+    def test_disconnect_without_session(self):
+        LivySessionManager.disconnect()
+
+
+class TestBackoff(unittest.TestCase):
+    def test_backoff_honors_retry_after(self):
+        response = mock.Mock(headers={"Retry-After": "3"})
+        self.assertEqual(livysession._backoff_delay(4, response), 3.0)
+
+    def test_backoff_clamps_retry_after(self):
+        self.assertEqual(livysession._backoff_delay(0, mock.Mock(headers={"Retry-After": "-5"})), 0.0)
+        self.assertEqual(livysession._backoff_delay(0, mock.Mock(headers={"Retry-After": "86400"})), 60)
+
+    def test_backoff_is_jittered_and_capped(self):
+        response = mock.Mock(headers={})
+        with mock.patch("random.uniform", side_effect=lambda low, high: high) as mock_uniform:
+            delays = [livysession._backoff_delay(attempt, response) for attempt in range(5)]
+        self.assertEqual(delays, [10, 20, 40, 60, 60])
+        self.assertTrue(all(call.args[0] == 0 for call in mock_uniform.call_args_list))
+
+
+class TestRetryConditions(unittest.TestCase):
+    def test_execute_retries_on_known_error(self):
+        evalue = "Traceback ...\nRequest failed: HTTP/1.1 403 Forbidden ClientRequestId: 42"
+        self.assertTrue(livysession.check_retry_condition_when_execute({"output": {"status": "error", "evalue": evalue}}))
+
+    def test_execute_does_not_retry_other_errors(self):
+        res = {"output": {"status": "error", "evalue": "AnalysisException: table not found"}}
+        self.assertFalse(livysession.check_retry_condition_when_execute(res))
+        self.assertFalse(livysession.check_retry_condition_when_execute({"output": {"status": "ok"}}))
+
+
+class TestJson(unittest.TestCase):
+    def test_json_round_trip(self):
+        payload = {"code": "select 'é'", "kind": "sql"}
+        self.assertEqual(json.loads(livysession._json_dumps(payload)), payload)
+        self.assertEqual(livysession._json_loads(_response(payload)), payload)
+
+    def test_json_falls_back_to_stdlib(self):
+        payload = {"code": "select 1", "kind": "sql"}
+        with mock.patch.object(livysession, "orjson", None):
+            self.assertEqual(livysession._json_dumps(payload), json.dumps(payload))
+            self.assertEqual(livysession._json_loads(_response(payload)), payload)
+
+
+class TestHttpSessions(unittest.TestCase):
+    def _retry(self, session):
+        return session.get_adapter("https://api.fabric.microsoft.com").max_retries
+
+    def test_idempotent_requests_retry_gateway_errors(self):
+        retry = self._retry(livysession._http_session)
+        self.assertTrue(retry.is_retry("GET", 502))
+        self.assertTrue(retry.is_retry("DELETE", 504))
+        self.assertFalse(retry.is_retry("POST", 429))
+
+    def test_post_only_retries_unprocessed_statuses(self):
+        retry = self._retry(livysession._http_post_session)
+        self.assertTrue(retry.is_retry("POST", 429))
+        self.assertTrue(retry.is_retry("POST", 503))
+        for status in (500, 502, 504):
+            self.assertFalse(retry.is_retry("POST", status))
+        self.assertFalse(retry.read)
+
+    def test_adapter_retry_after_is_capped(self):
+        for session in (livysession._http_session, livysession._http_post_session):
+            retry = self._retry(session).increment("GET", "/sessions")
+            response = mock.Mock(headers={"Retry-After": "86400"})
+            self.assertEqual(retry.get_retry_after(response), livysession.DEFAULT_EXECUTE_RETRIES_WAIT_MAX)
+            self.assertEqual(retry.get_retry_after(mock.Mock(headers={"Retry-After": "3"})), 3)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = livysession._CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.before_request()
+        self.breaker.record_failure()
+        with self.assertRaises(livysession.DbtDatabaseError):
+            self.breaker.before_request()
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.before_request()
+        self.assertEqual(self.breaker.state, livysession._CircuitBreaker.CLOSED)
+
+    def test_half_open_probe_after_reset_timeout(self):
+        with mock.patch("time.monotonic", return_value=100):
+            self.breaker.record_failure()
+            self.breaker.record_failure()
+        with mock.patch("time.monotonic", return_value=131):
+            self.breaker.before_request()
+            self.assertEqual(self.breaker.state, livysession._CircuitBreaker.HALF_OPEN)
+            with self.assertRaises(livysession.DbtDatabaseError):
+                self.breaker.before_request()
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, livysession._CircuitBreaker.OPEN)
+
+    def test_do_request_counts_server_errors(self):
+        http = mock.Mock()
+        http.request.return_value.status_code = 503
+        with mock.patch.object(livysession, "_circuit_breaker", self.breaker):
+            livysession._do_request(http, "GET", "url")
+            livysession._do_request(http, "GET", "url")
+            with self.assertRaises(livysession.DbtDatabaseError):
+                livysession._do_request(http, "GET", "url")
+        self.assertEqual(http.request.call_count, 2)
+
+
+class TestGetHeaders(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(livysession, accessToken=None, _cached_headers=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_token_refresh_window(self):
+        with mock.patch("time.time", return_value=1000):
+            self.assertFalse(livysession.is_token_refresh_necessary(1301))
+            self.assertTrue(livysession.is_token_refresh_necessary(1299))
+
+    def test_sp_token_uses_persistent_cache(self):
+        with mock.patch.multiple(livysession, _sp_credential=None, _sp_credential_persistent=False), \
+                mock.patch.object(livysession, "ClientSecretCredential") as mock_credential:
+            livysession.get_sp_access_token(_credentials())
+            livysession.get_sp_access_token(_credentials())
+            mock_credential.assert_called_once()
+            options = mock_credential.call_args.kwargs["cache_persistence_options"]
+            self.assertEqual(options.name, livysession.TOKEN_CACHE_NAME)
+            self.assertFalse(options.allow_unencrypted_storage)
+
+    def test_sp_token_falls_back_to_memory_cache(self):
+        persistent, in_memory = mock.Mock(), mock.Mock()
+        error = livysession.ClientAuthenticationError("Authentication failed: Cache encryption is impossible")
+        error.__cause__ = ValueError("Cache encryption is impossible because libsecret dependencies are not installed")
+        persistent.get_token.side_effect = error
+        with mock.patch.multiple(livysession, _sp_credential=None, _sp_credential_persistent=False), \
+                mock.patch.object(livysession, "ClientSecretCredential", side_effect=[persistent, in_memory]) as mock_credential:
+            self.assertIs(livysession.get_sp_access_token(_credentials()), in_memory.get_token.return_value)
+            self.assertNotIn("cache_persistence_options", mock_credential.call_args.kwargs)
+
+    def test_sp_token_auth_failure_does_not_fall_back(self):
+        persistent = mock.Mock()
+        persistent.get_token.side_effect = livysession.ClientAuthenticationError("invalid client secret")
+        with mock.patch.multiple(livysession, _sp_credential=None, _sp_credential_persistent=False), \
+                mock.patch.object(livysession, "ClientSecretCredential", return_value=persistent) as mock_credential:
+            with self.assertRaises(livysession.ClientAuthenticationError):
+                livysession.get_sp_access_token(_credentials())
+            mock_credential.assert_called_once()
+            self.assertIs(livysession._sp_credential, persistent)
+
+    def test_headers_are_reused_until_token_rotates(self):
+        token = livysession.AccessToken("token-1", 10**10)
+        with mock.patch.object(livysession, "get_cli_access_token", return_value=token) as mock_token:
+            first = livysession.get_headers(_credentials())
+            second = livysession.get_headers(_credentials())
+            mock_token.assert_called_once()
+            self.assertIs(first, second)
+            self.assertEqual(first["Authorization"], "Bearer token-1")
+
+    def test_headers_built_when_token_published_without_them(self):
+        # another thread may have published a fresh token but not yet its headers
+        livysession.accessToken = livysession.AccessToken("token-2", 10**10)
+        with mock.patch.object(livysession, "get_cli_access_token") as mock_token:
+            headers = livysession.get_headers(_credentials())
+            mock_token.assert_not_called()
+        self.assertEqual(headers["Authorization"], "Bearer token-2")